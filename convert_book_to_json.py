@@ -5,120 +5,179 @@ Automatically detects sections, stories, and content boundaries.
 """
 
 import json
+import mmap
 import re
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
 from typing import Dict, List, Any, Tuple
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    # Fall back to the standard library encoder
+    orjson = None
+
+# Precompiled patterns used by clean_text
+_WS_RE = re.compile(r'\s+')
+_MARK_RE = re.compile(r'⟪[^⟫]*⟫')
+_BAD_RE = re.compile(r'[^\w\s.,!?;:\'"()-]')
+# Translation table deleting the same characters as _BAD_RE, for ASCII text
+_ASCII_DROP_TABLE = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128)) if _BAD_RE.match(c)
+))
+
+# Header patterns shared by story and section detection
+_HEADER_PATTERNS: Tuple[str, ...] = (
+    r'^[A-Z][A-Z\s]+$',  # ALL CAPS headers (likely story titles)
+    r'^Chapter\s+\d+',    # Chapter X
+    r'^Part\s+\d+',       # Part X
+    r'^Story\s+\d+',      # Story X
+)
+
+# Additional patterns for generic section headers
+_SECTION_EXTRA: Tuple[str, ...] = (
+    r'^[A-Z][a-z\s]+:$',  # Title Case: headers
+    r'^Section\s+\d+',    # Section X
+    r'^[A-Z][a-z\s]{10,}$',  # Long title case lines
+)
+
+# Additional story/chapter indicators
+_STORY_EXTRA: Tuple[str, ...] = (
+    r'^[A-Z][a-z\s]{15,}$',  # Long title case lines (likely story titles)
+)
+
+def _combine_patterns(patterns: Tuple[str, ...]) -> re.Pattern:
+    """Fuse header patterns into one alternation so each line is matched once."""
+    return re.compile('|'.join(f'(?P<g{i}>{p})' for i, p in enumerate(patterns)))
+
+_SECTION_RE = _combine_patterns(_HEADER_PATTERNS + _SECTION_EXTRA)
+_STORY_RE = _combine_patterns(_HEADER_PATTERNS + _STORY_EXTRA)
+
+# Patterns used to build safe filenames for individual section files
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\s-]')
+_FILENAME_SEP_RE = re.compile(r'[-\s]+')
+
 def clean_text(text: str) -> str:
     """Clean and normalize text content."""
-    # Remove excessive whitespace and normalize
-    text = re.sub(r'\s+', ' ', text.strip())
     # Remove common content markers and special characters
-    text = re.sub(r'⟪[^⟫]*⟫', '', text)
-    text = re.sub(r'[^\w\s.,!?;:\'"()-]', '', text)
-    return text
+    text = _MARK_RE.sub('', text)
+    if text.isascii():
+        text = text.translate(_ASCII_DROP_TABLE)
+    else:
+        text = _BAD_RE.sub('', text)
+    # Remove excessive whitespace and normalize (last, so removals above
+    # cannot leave double or trailing spaces behind)
+    return _WS_RE.sub(' ', text).strip()
 
-def detect_section_patterns(content: str) -> List[Dict[str, Any]]:
-    """Automatically detect section boundaries in the text."""
-    lines = content.split('\n')
-    sections = []
-    
-    # Common patterns for section headers
-    section_patterns = [
-        r'^[A-Z][A-Z\s]+$',  # ALL CAPS headers
-        r'^[A-Z][a-z\s]+:$',  # Title Case: headers
-        r'^Chapter\s+\d+',    # Chapter X
-        r'^Part\s+\d+',       # Part X
-        r'^Section\s+\d+',    # Section X
-        r'^Story\s+\d+',      # Story X
-        r'^[A-Z][a-z\s]{10,}$',  # Long title case lines
+def count_words(cleaned_text: str) -> int:
+    """Count words in text already normalized by clean_text."""
+    # clean_text leaves exactly one space between words, so no split is needed
+    return cleaned_text.count(' ') + 1 if cleaned_text else 0
+
+def _next_content_line(nonempty: List[int], k: int, total_lines: int) -> int:
+    """Index of the non-empty line after nonempty[k], or total_lines if none."""
+    return nonempty[k + 1] if k + 1 < len(nonempty) else total_lines
+
+def _classify_lines(pattern: re.Pattern, stripped: List[str], nonempty: List[int],
+                    min_length: int = 1) -> List[int]:
+    """Return the positions in `nonempty` whose line matches the header pattern."""
+    match = pattern.match
+    return [
+        k for k, line in enumerate(map(stripped.__getitem__, nonempty))
+        if len(line) >= min_length and match(line)
     ]
+
+def detect_section_patterns(stripped: List[str], nonempty: List[int]) -> List[Dict[str, Any]]:
+    """Automatically detect section boundaries in the already stripped lines.
     
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
-            
-        # Check if line matches any section pattern
-        for pattern in section_patterns:
-            if re.match(pattern, line):
-                # Look for content start (next non-empty line or after a few lines)
-                content_start = i + 1
-                while content_start < len(lines) and not lines[content_start].strip():
-                    content_start += 1
-                
-                sections.append({
-                    "title": line,
-                    "line": i + 1,
-                    "start_content": content_start + 1
-                })
-                break
+    `nonempty` holds the indices of the non-empty lines in `stripped`.
+    """
+    sections = []
+    
+    # Only lines matching a section pattern are visited
+    for k in _classify_lines(_SECTION_RE, stripped, nonempty):
+        i = nonempty[k]
+        
+        # Content starts at the next non-empty line
+        content_start = _next_content_line(nonempty, k, len(stripped))
+        
+        sections.append({
+            "title": stripped[i],
+            "line": i + 1,
+            "start_content": content_start + 1
+        })
     
     return sections
 
-def detect_story_boundaries(content: str) -> List[Dict[str, Any]]:
-    """Detect story or chapter boundaries using various heuristics."""
-    lines = content.split('\n')
-    stories = []
+def detect_story_boundaries(stripped: List[str], nonempty: List[int]) -> List[Dict[str, Any]]:
+    """Detect story or chapter boundaries in the already stripped lines.
     
-    # Look for common story/chapter indicators
-    story_indicators = [
-        r'^[A-Z][a-z\s]{15,}$',  # Long title case lines (likely story titles)
-        r'^Chapter\s+\d+',       # Chapter X
-        r'^Part\s+\d+',          # Part X
-        r'^Story\s+\d+',         # Story X
-        r'^[A-Z][A-Z\s]+$',      # ALL CAPS (likely story titles)
-    ]
+    `nonempty` holds the indices of the non-empty lines in `stripped`.
+    """
+    stories = []
     
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line or len(line) < 10:  # Skip short lines
-            continue
-            
-        # Check if line matches story patterns
-        for pattern in story_indicators:
-            if re.match(pattern, line):
-                # Find where actual content starts (skip empty lines)
-                content_start = i + 1
-                while content_start < len(lines) and not lines[content_start].strip():
-                    content_start += 1
-                
-                # Only consider it a story if there's substantial content after
-                if content_start < len(lines) - 10:  # At least 10 lines of content
-                    stories.append({
-                        "title": line,
-                        "line": i + 1,
-                        "start_content": content_start + 1
-                    })
-                break
+    # Only lines matching story patterns are visited (short lines are skipped)
+    for k in _classify_lines(_STORY_RE, stripped, nonempty, min_length=10):
+        i = nonempty[k]
+        
+        # Find where actual content starts (next non-empty line)
+        content_start = _next_content_line(nonempty, k, len(stripped))
+        
+        # Only consider it a story if there's substantial content after
+        if content_start < len(stripped) - 10:  # At least 10 lines of content
+            stories.append({
+                "title": stripped[i],
+                "line": i + 1,
+                "start_content": content_start + 1
+            })
     
     return stories
 
-def extract_content_sections(content: str) -> List[Dict[str, Any]]:
-    """Extract all content sections from the book using automatic detection."""
+def extract_content_sections(content: str) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Extract all content sections from the book using automatic detection.
+    
+    Returns the sections together with their aggregate statistics.
+    """
     lines = content.split('\n')
+    # Strip every line once; both detectors work on the stripped copies
+    stripped = [line.strip() for line in lines]
+    nonempty = [i for i, line in enumerate(stripped) if line]
     
     # Try to detect stories/chapters first
-    stories = detect_story_boundaries(content)
+    stories = detect_story_boundaries(stripped, nonempty)
     
     # If no stories detected, try general sections
     if not stories:
-        stories = detect_section_patterns(content)
+        stories = detect_section_patterns(stripped, nonempty)
     
     # If still no sections, create a single section for the entire content
     if not stories:
+        cleaned_content = clean_text(content)
+        word_count = count_words(cleaned_content)
         return [{
             "type": "content",
             "title": "Full Content",
-            "content": clean_text(content),
+            "content": cleaned_content,
             "start_line": 1,
             "end_line": len(lines),
-            "word_count": len(clean_text(content).split()),
-            "character_count": len(clean_text(content))
-        }]
+            "word_count": word_count,
+            "character_count": len(cleaned_content)
+        }], {
+            "total_sections": 1,
+            "stories": 0,
+            "total_words": word_count,
+            "total_characters": len(cleaned_content)
+        }
+    
+    # Character offset of the start of each line, so section text can be
+    # sliced straight out of the content instead of re-joining line lists
+    line_offsets = [0, *accumulate(len(line) + 1 for line in lines)]
     
     sections = []
+    total_words = 0
+    total_characters = 0
     
     # Process each detected section
     for i, story in enumerate(stories):
@@ -130,15 +189,21 @@ def extract_content_sections(content: str) -> List[Dict[str, Any]]:
         else:
             end_line = len(lines)
         
-        # Extract content
-        story_lines = lines[start_line:end_line]
-        story_content = '\n'.join(story_lines)
+        # Extract content (without the newline that ends the last line)
+        story_content = content[line_offsets[start_line]:line_offsets[end_line] - 1]
+        
+        # Skip sections that cannot reach 50 words before paying for cleaning;
+        # clean_text only removes characters, so it never adds words
+        if len(story_content.split(None, 49)) < 50:
+            continue
         
         # Clean the content
         cleaned_content = clean_text(story_content)
         
+        word_count = count_words(cleaned_content)
+        
         # Skip sections with very little content
-        if len(cleaned_content.split()) < 50:
+        if word_count < 50:
             continue
         
         sections.append({
@@ -147,13 +212,73 @@ def extract_content_sections(content: str) -> List[Dict[str, Any]]:
             "content": cleaned_content,
             "start_line": start_line + 1,
             "end_line": end_line,
-            "word_count": len(cleaned_content.split()),
+            "word_count": word_count,
             "character_count": len(cleaned_content)
         })
+        total_words += word_count
+        total_characters += len(cleaned_content)
     
-    return sections
+    # Every detected section is a story, so no need to count them by type
+    return sections, {
+        "total_sections": len(sections),
+        "stories": len(sections),
+        "total_words": total_words,
+        "total_characters": total_characters
+    }
+
+def _decode_text(buffer) -> str:
+    """Decode a raw text buffer, falling back to latin-1 for non-UTF-8 input."""
+    try:
+        content = str(buffer, 'utf-8')
+    except UnicodeDecodeError:
+        # Try with different encoding against the same buffer
+        content = str(buffer, 'latin-1')
+    
+    # Match the universal newline handling of text-mode reads
+    return content.replace('\r\n', '\n').replace('\r', '\n')
+
+def read_text_file(input_file: str) -> str:
+    """Read a text file through a read-only memory map, decoding it in one go."""
+    with open(input_file, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Pipes, devices, size-0 pseudo files and empty files cannot be
+            # memory-mapped; read them through the regular buffered path
+            return _decode_text(f.read())
+        with buffer:
+            return _decode_text(buffer)
+
+def write_json(data: Any, output_file: str) -> None:
+    """Write data as indented UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+def section_filename(section: Dict[str, Any]) -> str:
+    """Build a safe filename for an individual section file."""
+    safe_title = _UNSAFE_FILENAME_RE.sub('', section["title"])
+    safe_title = _FILENAME_SEP_RE.sub('_', safe_title)
+    return f"section_{safe_title}.json"
+
+def write_section_files(sections: List[Dict[str, Any]]) -> None:
+    """Write each section to its own JSON file, overlapping the file writes."""
+    # Sections with the same title share a file; keep the last one, as a
+    # sequential write would, so no two threads write the same path
+    files = {section_filename(section): section for section in sections}
+    
+    def write_section(section_file: str) -> str:
+        write_json(files[section_file], section_file)
+        return section_file
+    
+    with ThreadPoolExecutor() as executor:
+        for section_file in executor.map(write_section, files):
+            print(f"Created: {section_file}")
 
-def create_book_metadata(input_file: str, sections: List[Dict[str, Any]]) -> Dict[str, Any]:
+def create_book_metadata(input_file: str, statistics: Dict[str, int]) -> Dict[str, Any]:
     """Create metadata for the book based on filename and content analysis."""
     file_path = Path(input_file)
     
@@ -163,56 +288,46 @@ def create_book_metadata(input_file: str, sections: List[Dict[str, Any]]) -> Dic
     return {
         "title": title,
         "source_file": input_file,
-        "total_sections": len(sections),
-        "stories": len([s for s in sections if s["type"] == "story"]),
+        "total_sections": statistics["total_sections"],
+        "stories": statistics["stories"],
         "conversion_date": "2024",
         "conversion_notes": "Converted from text format to structured JSON using automatic section detection"
     }
 
-def convert_book_to_json(input_file: str, output_file: str) -> None:
-    """Convert any text file to structured JSON format."""
+def convert_book_to_json(input_file: str, output_file: str) -> Dict[str, Any]:
+    """Convert any text file to structured JSON format and return the structure."""
     
     print(f"Reading text from: {input_file}")
     
     # Read the input file
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-    except UnicodeDecodeError:
-        # Try with different encoding
-        with open(input_file, 'r', encoding='latin-1') as f:
-            content = f.read()
+    content = read_text_file(input_file)
     
     print("Analyzing content structure...")
     
     # Extract sections using automatic detection
-    sections = extract_content_sections(content)
+    sections, statistics = extract_content_sections(content)
     
     # Create book metadata
-    metadata = create_book_metadata(input_file, sections)
+    metadata = create_book_metadata(input_file, statistics)
     
     # Create the final JSON structure
     book_json = {
         "metadata": metadata,
         "sections": sections,
-        "statistics": {
-            "total_sections": len(sections),
-            "stories": len([s for s in sections if s["type"] == "story"]),
-            "total_words": sum(s["word_count"] for s in sections),
-            "total_characters": sum(s["character_count"] for s in sections)
-        }
+        "statistics": statistics
     }
     
     print(f"Writing structured JSON to: {output_file}")
     
     # Write the JSON file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(book_json, f, indent=2, ensure_ascii=False)
+    write_json(book_json, output_file)
     
     print("Conversion completed successfully!")
     print(f"Total sections processed: {len(sections)}")
     print(f"Total words: {book_json['statistics']['total_words']}")
     print(f"Total characters: {book_json['statistics']['total_characters']}")
+    
+    return book_json
 
 def main():
     """Main function to run the conversion."""
@@ -231,24 +346,12 @@ def main():
         output_file = f"{input_path.stem}_structured.json"
     
     try:
-        convert_book_to_json(args.input_file, output_file)
+        book_json = convert_book_to_json(args.input_file, output_file)
         
         # Create individual section files if requested
         if args.individual:
             print("\nCreating individual section files...")
-            with open(output_file, 'r', encoding='utf-8') as f:
-                book_data = json.load(f)
-            
-            for section in book_data["sections"]:
-                # Create a safe filename
-                safe_title = re.sub(r'[^\w\s-]', '', section["title"])
-                safe_title = re.sub(r'[-\s]+', '_', safe_title)
-                section_file = f"section_{safe_title}.json"
-                
-                with open(section_file, 'w', encoding='utf-8') as f:
-                    json.dump(section, f, indent=2, ensure_ascii=False)
-                
-                print(f"Created: {section_file}")
+            write_section_files(book_json["sections"])
         
         print(f"\nConversion completed!")
         print(f"Main structured file: {output_file}")
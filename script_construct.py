@@ -1,37 +1,56 @@
 import os
 import json
 import time
+import asyncio
+import tiktoken
+from openai import RateLimitError
+from tenacity import RetryError
 from hypergraphrag import HyperGraphRAG
+from hypergraphrag.prompt import PROMPTS
+from hypergraphrag.utils import encode_string_by_tiktoken
 
 os.environ["OPENAI_API_KEY"] = ""
 
 rag = HyperGraphRAG(working_dir=f"expr/example")
 
 preferred_story = "Story"
+# Tokens per inserted chunk. ainsert re-chunks documents with a stride of
+# chunk_token_size - chunk_overlap_token_size, so chunks no longer than that
+# stride are extracted in a single pass
+extraction_stride = rag.chunk_token_size - rag.chunk_overlap_token_size
+chunk_token_size = extraction_stride
 
 # Load the structured book data
 with open("Book_structured.json", "r", encoding="utf-8") as f:
     book_data = json.load(f)
 
-def chunk_text(text, chunk_size=5000):
-    """Split text into smaller chunks to avoid rate limits."""
-    words = text.split()
+encoder = tiktoken.encoding_for_model(rag.tiktoken_model_name)
+
+def escape_special_tokens(text):
+    """Break up special-token text such as <|endoftext|>.
+
+    ainsert re-encodes documents with tiktoken's encode, which raises on
+    special-token text; "<|" also starts the extraction prompt's delimiters.
+    """
+    return text.replace("<|", "< |")
+
+def chunk_by_tokens(text, max_tokens):
+    """Split text into chunks of at most `max_tokens` tokens, cut between words."""
+    tokens = encoder.encode_ordinary(text)
     chunks = []
-    current_chunk = []
-    current_size = 0
-    
-    for word in words:
-        if current_size + len(word) + 1 > chunk_size and current_chunk:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [word]
-            current_size = len(word)
-        else:
-            current_chunk.append(word)
-            current_size += len(word) + 1
-    
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
-    
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        if end < len(tokens):
+            # Back off to the last token that begins with whitespace so no word
+            # is split; keep the hard cut if the window has no whitespace at all
+            cut = end
+            while cut > start and not encoder.decode_single_token_bytes(tokens[cut])[:1].isspace():
+                cut -= 1
+            if cut > start:
+                end = cut
+        chunks.append((encoder.decode(tokens[start:end]).strip(), end - start))
+        start = end
     return chunks
 
 # Extract story content and chunk it
@@ -46,41 +65,116 @@ for section in book_data["sections"]:
             continue
             
         # Add story title as context
-        full_content = f"Title: {story_title}\n\n{content}"
+        full_content = escape_special_tokens(f"Title: {story_title}\n\n{content}")
         
-        # Split into smaller chunks based on rate limits
-        # Assuming gpt-4o (30k TPM) - use 25k tokens = ~100k characters for safety
-        chunks = chunk_text(full_content, chunk_size=100000)  # ~100k characters per chunk
+        # Split into smaller chunks; the rate limiter below paces them
+        chunks = chunk_by_tokens(full_content, chunk_token_size)
         
         print(f"Story '{story_title}' split into {len(chunks)} chunks")
         all_chunks.extend(chunks)
 
 print(f"\nTotal chunks to process: {len(all_chunks)}")
 
-# Process chunks one at a time with delays
-delay_between_chunks = 3  # Wait 3 seconds between chunks (rate limit is per minute)
+# Insert chunks in batches; a single ainsert already extracts the chunks of a
+# batch concurrently (up to llm_model_max_async), while separate concurrent
+# ainsert calls on one instance would race when merging shared entities.
+# Batches are filled up to one minute of the token budget.
+tokens_per_minute = 30000  # gpt-4o TPM budget
+max_retries = 5  # Retries per batch when the rate limit is hit
+retry_base_delay = 2  # Seconds; doubled after every rate limited attempt
+
+class TokenBucket:
+    """Async token bucket that refills `capacity` tokens every `period` seconds."""
+
+    def __init__(self, capacity, period=60):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-for i, chunk in enumerate(all_chunks):
-    print(f"\nProcessing chunk {i+1}/{len(all_chunks)} (length: {len(chunk)} chars)")
+    async def acquire(self, amount):
+        # A request larger than the bucket can only ever wait for a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+# Inserting a chunk costs far more than its own tokens: every extraction
+# sub-chunk is sent with the extraction prompt and examples, then resent with
+# the history for each gleaning pass and each "continue?" check
+extraction_prompt_tokens = len(encode_string_by_tiktoken(
+    PROMPTS["entity_extraction"] + "\n".join(PROMPTS["entity_extraction_examples"])
+))
+extraction_calls = max(1, 2 * rag.entity_extract_max_gleaning)
+
+def estimate_insert_tokens(chunk_tokens):
+    """Rough number of LLM tokens spent inserting a chunk of `chunk_tokens`."""
+    # Same stride as chunking_by_token_size; every sub-chunk after the first
+    # repeats the overlap and pays the full extraction prompt
+    sub_chunks = max(1, -(-chunk_tokens // extraction_stride))
+    input_tokens = chunk_tokens + (sub_chunks - 1) * rag.chunk_overlap_token_size
+    return extraction_calls * (input_tokens + sub_chunks * extraction_prompt_tokens)
+
+def make_batches():
+    """Group chunks into batches whose estimated cost fits the token budget."""
+    batches = []
+    for i, (chunk, chunk_tokens) in enumerate(all_chunks):
+        cost = estimate_insert_tokens(chunk_tokens)
+        if batches and batches[-1]["cost"] + cost <= tokens_per_minute:
+            batches[-1]["chunks"].append(chunk)
+            batches[-1]["cost"] += cost
+        else:
+            batches.append({"first": i, "chunks": [chunk], "cost": cost})
+    return batches
+
+def is_rate_limit_error(e):
+    # The LLM calls retry on rate limits themselves and then raise RetryError
+    if isinstance(e, RetryError):
+        e = e.last_attempt.exception()
+    return isinstance(e, RateLimitError) or "rate limit" in str(e).lower()
+
+async def insert_batch(batch, limiter):
+    chunks = batch["chunks"]
+    label = f"chunks {batch['first']+1}-{batch['first']+len(chunks)}"
     
-    try:
-        rag.insert([chunk])  # Insert as single-item list
-        print(f"✅ Successfully processed chunk {i+1}")
-    except Exception as e:
-        print(f"❌ Error processing chunk {i+1}: {e}")
-        if "rate limit" in str(e).lower():
-            print("⏳ Rate limit hit, waiting 15 seconds before retry...")
-            time.sleep(15)
-            try:
-                rag.insert([chunk])
-                print(f"✅ Successfully processed chunk {i+1} on retry")
-            except Exception as retry_e:
-                print(f"❌ Failed on retry: {retry_e}")
-                break  # Stop if we keep hitting rate limits
+    print(f"\nProcessing {label}/{len(all_chunks)} (length: {sum(map(len, chunks))} chars, ~{batch['cost']} tokens)")
     
-    # Wait between chunks to respect rate limits
-    if i + 1 < len(all_chunks):
-        print(f"⏳ Waiting {delay_between_chunks} seconds before next chunk...")
-        time.sleep(delay_between_chunks)
+    for attempt in range(max_retries + 1):
+        # Wait until the batch's estimated tokens fit in the per-minute budget;
+        # a retry spends them again
+        await limiter.acquire(batch["cost"])
+        try:
+            await rag.ainsert(chunks)
+            print(f"✅ Successfully processed {label}")
+            return True
+        except Exception as e:
+            print(f"❌ Error processing {label}: {e}")
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                return False
+            wait = retry_base_delay * 2 ** attempt
+            print(f"⏳ Rate limit hit, waiting {wait} seconds before retrying {label}...")
+            await asyncio.sleep(wait)
+
+async def insert_all_chunks():
+    limiter = TokenBucket(tokens_per_minute)
+    for batch in make_batches():
+        if not await insert_batch(batch, limiter):
+            # Extraction tasks of the failed insert may still be running on
+            # this instance, so stop instead of starting the next batch
+            print("🛑 Stopping; remaining chunks were not processed")
+            return list(range(batch["first"] + 1, len(all_chunks) + 1))
+    return []
+
+failed = asyncio.run(insert_all_chunks())
 
-print("\n🎉 All chunks processed!")
\ No newline at end of file
+if failed:
+    print(f"\n⚠️ Failed or unprocessed chunks: {failed}")
+else:
+    print("\n🎉 All chunks processed!")